@@ -1,8 +1,14 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
 import socket
 import struct
-import threading
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # ANSI color helpers
 COLOR_RESET = "\033[0m"
@@ -22,96 +28,241 @@ MSG_TYPE_OFFER = 0x2
 MSG_TYPE_REQUEST = 0x3
 MSG_TYPE_PAYLOAD = 0x4
 
+# Precompiled packet layouts (format strings are parsed once, not per packet)
+OFFER_HEADER = struct.Struct("!IBHH")  # magic cookie, msg type, server UDP port, server TCP port
+REQUEST_PACKET = struct.Struct("!IBQ")  # magic cookie, msg type, file size
+PAYLOAD_HEADER = struct.Struct("!IBQQ")  # magic cookie, msg type, total segments, current segment
+
 CLIENT_LISTEN_PORT = 13117  # Where we listen for broadcast offers
 
+# Kernel socket buffer size for UDP downloads (12 MiB).
+# Non-root processes are capped by net.core.{w,r}mem_max, so raise those first:
+#   sysctl -w net.core.wmem_max=12582912 net.core.rmem_max=12582912
+SOCKET_BUFFER_SIZE = 12_582_912
+
+TCP_RECV_BUFFER_SIZE = 256 * 1024  # reused by recv_into, one per TCP worker
+
+UDP_BATCH_SIZE = 64  # datagrams drained per recvmmsg() call
+UDP_RECV_BUFFER_SIZE = 2048  # per-datagram receive slot, larger than any payload packet
+UDP_IDLE_TIMEOUT = 1.0  # seconds without a datagram before a UDP transfer counts as done
+
+
+# Linux recvmmsg(2) via ctypes, so a UDP download costs one syscall per UDP_BATCH_SIZE packets
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
 
-# Worker thread for TCP transfer
-def tcp_download_worker(server_ip, server_tcp_port, file_size, idx, results_list):
-    import time
-    start_time = time.time()
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    """
+    Returns libc's recvmmsg, or None where it doesn't exist (non-Linux).
+    """
+    if not sys.platform.startswith("linux"):
+        # find_library("c") is None on Windows, and CDLL(None) raises TypeError there
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    func.restype = ctypes.c_int
+    return func
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+def wait_readable(sel, timeout):
+    """
+    Wait until the socket registered with selector 'sel' is readable.
+    Returns False if nothing arrived within 'timeout' seconds.
+    """
+    return bool(sel.select(timeout))
+
+
+def recv_udp_batches(s):
+    """
+    Yield batches of received datagrams as lists of (buffer, nbytes).
+    - Blocks the calling thread; run it off the event loop.
+    - Stops once no datagram arrives within UDP_IDLE_TIMEOUT seconds.
+    - Reads into preallocated buffers: recvmmsg() when available, recv_into() otherwise.
+    """
+    # A selector (epoll on Linux) rather than select.select, which rejects fds >= 1024
+    with selectors.DefaultSelector() as sel:
+        sel.register(s, selectors.EVENT_READ)
+        yield from _recv_udp_batches(s, sel)
+
+
+def _recv_udp_batches(s, sel):
+    if _recvmmsg is None:
+        # One datagram per recv_into, but each wakeup drains up to a batch into reusable buffers
+        buffers = [bytearray(UDP_RECV_BUFFER_SIZE) for _ in range(UDP_BATCH_SIZE)]
+        while wait_readable(sel, UDP_IDLE_TIMEOUT):
+            batch = []
+            for buf in buffers:
+                try:
+                    nbytes = s.recv_into(buf)
+                except BlockingIOError:
+                    break
+                batch.append((buf, nbytes))
+            if batch:
+                yield batch
+        return
+
+    buffers = [ctypes.create_string_buffer(UDP_RECV_BUFFER_SIZE) for _ in range(UDP_BATCH_SIZE)]
+    iovs = (_IoVec * UDP_BATCH_SIZE)()
+    msgs = (_MMsgHdr * UDP_BATCH_SIZE)()
+    for i, buf in enumerate(buffers):
+        iovs[i].iov_base = ctypes.addressof(buf)
+        iovs[i].iov_len = len(buf)
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    fd = s.fileno()
+    msgs_addr = ctypes.addressof(msgs)
+    while wait_readable(sel, UDP_IDLE_TIMEOUT):
+        # Drain everything already queued before waiting again
+        while True:
+            n = _recvmmsg(fd, msgs_addr, UDP_BATCH_SIZE, 0, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err == errno.EAGAIN:
+                    break
+                raise OSError(err, os.strerror(err))
+            yield [(buffers[i], msgs[i].msg_len) for i in range(n)]
+
+
+# Worker coroutine for TCP transfer
+async def tcp_download_worker(server_ip, server_tcp_port, file_size, idx):
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
     total_received = 0
 
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_ip, server_tcp_port))
+            s.setblocking(False)
+            await loop.sock_connect(s, (server_ip, server_tcp_port))
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # don't delay the short request line
             # Send file_size as string + newline
             request_str = str(file_size) + "\n"
-            s.sendall(request_str.encode())
+            await loop.sock_sendall(s, request_str.encode())
 
-            # Receive the bytes
+            # Receive the bytes into a reusable buffer (no allocation per recv)
+            buf = memoryview(bytearray(TCP_RECV_BUFFER_SIZE))
             while total_received < file_size:
-                data = s.recv(4096)
-                if not data:
+                n = await loop.sock_recv_into(s, buf)
+                if not n:
                     break
-                total_received += len(data)
+                total_received += n
+                # sock_recv_into doesn't yield while data is buffered; let other streams run
+                await asyncio.sleep(0)
     except Exception as e:
         cprint(f"[TCP-{idx + 1}] Error: {e}", COLOR_RED)
 
-    end_time = time.time()
+    end_time = time.perf_counter()
     duration = end_time - start_time
     speed_bps = (total_received * 8) / duration if duration > 0 else 0
-    results_list[idx] = (duration, speed_bps, total_received)
+    return (duration, speed_bps, total_received)
 
 
-# Worker thread for UDP transfer
-def udp_download_worker(server_ip, server_udp_port, file_size, idx, results_list):
-    import time
-    start_time = time.time()
+# Worker for UDP transfer; runs in its own thread so the event loop's TCP work
+# can't delay its receives or its idle timeout
+def udp_download_worker(server_ip, server_udp_port, file_size, idx):
+    start_time = time.perf_counter()
     total_bytes_received = 0
     total_segments = None
-    received_segments = set()
+    received_bits = None  # bitset of received segment indices, sized on first payload
+    bad_packets = 0  # counted in the receive loop, reported once afterwards
 
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(1.0)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    s.setblocking(False)
 
     # Build request packet
     # Format: magic cookie (4 bytes), msg_type (1 byte), file_size (8 bytes)
-    request_packet = struct.pack("!IBQ", MAGIC_COOKIE, MSG_TYPE_REQUEST, file_size)
+    request_packet = REQUEST_PACKET.pack(MAGIC_COOKIE, MSG_TYPE_REQUEST, file_size)
     try:
         s.sendto(request_packet, (server_ip, server_udp_port))
     except Exception as e:
         cprint(f"[UDP-{idx + 1}] Error sending request: {e}", COLOR_RED)
         s.close()
-        results_list[idx] = (0, 0, 0, 0)
-        return
+        return (0, 0, 0, 0)
 
-    # Receive payload packets until timeout
-    while True:
-        try:
-            data, addr = s.recvfrom(65535)
-            if len(data) < 21:
-                continue
-            cookie, msg_type = struct.unpack_from("!IB", data, 0)
-            if cookie != MAGIC_COOKIE or msg_type != MSG_TYPE_PAYLOAD:
-                continue
-
-            # read total_segments and current_segment
-            total_seg, current_seg = struct.unpack_from("!QQ", data, 5)
-            payload = data[5 + 16:]
-            total_bytes_received += len(payload)
-
-            if total_segments is None:
-                total_segments = total_seg
-            received_segments.add(current_seg)
-
-        except socket.timeout:
-            # no data for 1 second => transfer done
-            break
-        except Exception as e:
-            cprint(f"[UDP-{idx + 1}] Error: {e}", COLOR_RED)
-            break
+    # Receive payload packets until timeout (no data for 1 second => transfer done)
+    try:
+        for batch in recv_udp_batches(s):
+            for data, nbytes in batch:
+                if nbytes < PAYLOAD_HEADER.size:
+                    bad_packets += 1
+                    continue
+                cookie, msg_type, total_seg, current_seg = PAYLOAD_HEADER.unpack_from(data, 0)
+                if cookie != MAGIC_COOKIE or msg_type != MSG_TYPE_PAYLOAD:
+                    bad_packets += 1
+                    continue
+                # Every segment carries at least one byte, so a larger count is garbage
+                # (and would make the bitset allocation blow up)
+                if total_seg > file_size:
+                    bad_packets += 1
+                    continue
+
+                total_bytes_received += nbytes - PAYLOAD_HEADER.size
+
+                if total_segments is None:
+                    total_segments = total_seg
+                    received_bits = bytearray((total_seg + 7) >> 3)
+                if current_seg < total_segments:
+                    received_bits[current_seg >> 3] |= 1 << (current_seg & 7)
+    except Exception as e:
+        cprint(f"[UDP-{idx + 1}] Error: {e}", COLOR_RED)
 
     s.close()
+    if bad_packets:
+        cprint(f"[UDP-{idx + 1}] Ignored {bad_packets} unexpected packets", COLOR_RED)
 
-    end_time = time.time()
+    end_time = time.perf_counter()
     duration = end_time - start_time
     speed_bps = (total_bytes_received * 8) / duration if duration > 0 else 0
     if total_segments is None:
         total_segments = 0
-    received_count = len(received_segments)
+    received_count = int.from_bytes(received_bits, "little").bit_count() if received_bits else 0
     success_percentage = (100.0 * received_count / total_segments) if total_segments > 0 else 0.0
 
-    results_list[idx] = (duration, speed_bps, total_bytes_received, success_percentage)
+    return (duration, speed_bps, total_bytes_received, success_percentage)
+
+
+async def run_speed_test(server_ip, server_tcp_port, server_udp_port, file_size, num_tcp, num_udp):
+    """
+    Run all TCP transfers on one event loop, with each UDP transfer on its own thread.
+    Returns (tcp_results, udp_results), each a list in connection order.
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max(num_udp, 1)) as udp_threads:
+        tcp_workers = [tcp_download_worker(server_ip, server_tcp_port, file_size, i) for i in range(num_tcp)]
+        udp_workers = [loop.run_in_executor(udp_threads, udp_download_worker,
+                                            server_ip, server_udp_port, file_size, i)
+                       for i in range(num_udp)]
+        results = await asyncio.gather(*tcp_workers, *udp_workers)
+    # Split on the workers actually started; a negative count starts none
+    return results[:len(tcp_workers)], results[len(tcp_workers):]
 
 
 def main():
@@ -136,12 +287,11 @@ def main():
                     cprint("No offer received, retrying...", COLOR_RED)
                     continue
 
-                if len(data) < 9:
+                if len(data) < OFFER_HEADER.size:
                     continue
-                cookie, msg_type = struct.unpack_from("!IB", data, 0)
+                cookie, msg_type, udp_port, tcp_port = OFFER_HEADER.unpack_from(data, 0)
                 if cookie == MAGIC_COOKIE and msg_type == MSG_TYPE_OFFER:
-                    # parse server ports
-                    server_udp_port, server_tcp_port = struct.unpack_from("!HH", data, 5)
+                    server_udp_port, server_tcp_port = udp_port, tcp_port
                     server_ip = addr[0]
                     cprint(f"Received offer from {server_ip}", COLOR_GREEN)
                     break  # exit the while loop
@@ -162,28 +312,9 @@ def main():
             time.sleep(2)
             continue
 
-        # 3) Start the speed tests
-        tcp_results = [None] * num_tcp
-        tcp_threads = []
-        for i in range(num_tcp):
-            t = threading.Thread(target=tcp_download_worker,
-                                 args=(server_ip, server_tcp_port, file_size, i, tcp_results))
-            t.start()
-            tcp_threads.append(t)
-
-        udp_results = [None] * num_udp
-        udp_threads = []
-        for i in range(num_udp):
-            t = threading.Thread(target=udp_download_worker,
-                                 args=(server_ip, server_udp_port, file_size, i, udp_results))
-            t.start()
-            udp_threads.append(t)
-
-        # Wait for all threads to finish
-        for t in tcp_threads:
-            t.join()
-        for t in udp_threads:
-            t.join()
+        # 3) Run the speed tests
+        tcp_results, udp_results = asyncio.run(
+            run_speed_test(server_ip, server_tcp_port, server_udp_port, file_size, num_tcp, num_udp))
 
         # 4) Print results
         for i, (duration, speed_bps, total_recv) in enumerate(tcp_results):
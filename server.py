@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
 import socket
 import struct
 import threading
 import time
 import sys
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # ANSI colors for terminal fun
 COLOR_RESET = "\033[0m"
@@ -24,14 +32,88 @@ MSG_TYPE_OFFER = 0x2
 MSG_TYPE_REQUEST = 0x3
 MSG_TYPE_PAYLOAD = 0x4
 
+# Precompiled packet layouts (format strings are parsed once, not per packet)
+OFFER_HEADER = struct.Struct("!IBHH")  # magic cookie, msg type, server UDP port, server TCP port
+REQUEST_PACKET = struct.Struct("!IBQ")  # magic cookie, msg type, file size
+PAYLOAD_HEADER = struct.Struct("!IBQQ")  # magic cookie, msg type, total segments, current segment
+
 # Broadcast settings
 BROADCAST_INTERVAL = 1.0  # in seconds
 BROADCAST_LISTEN_PORT = 13117  # Clients listen here
+BROADCAST_ADDRESS = ("255.255.255.255", BROADCAST_LISTEN_PORT)
 
 # For demonstration, we default these to some ports
 DEFAULT_UDP_PORT = 2025
 DEFAULT_TCP_PORT = 2026
-CHUNK_SIZE = 1024
+
+# A UDP datagram of 1472 bytes (header + payload) fits a 1500-byte Ethernet MTU
+# without IP fragmentation.
+UDP_DATAGRAM_SIZE = 1472
+UDP_CHUNK_SIZE = UDP_DATAGRAM_SIZE - PAYLOAD_HEADER.size
+
+# TCP payloads are sent with sendfile() from a sparse temp file of this size,
+# so the kernel never copies the dummy bytes from user space.
+TCP_PAYLOAD_FILE_SIZE = 1 << 30
+
+# Where os.sendfile() is missing (e.g. Windows), payloads are sent from this buffer instead
+TCP_FALLBACK_PAYLOAD = memoryview(bytes(1 << 20))
+
+# Datagrams handed to the kernel per sendmmsg() call
+UDP_BATCH_SIZE = 64
+
+# Non-blocking flag for a single recv on a blocking socket (absent on Windows)
+RECV_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Worker threads for the per-request transfers. UDP floods get their own pool so
+# long-running TCP sends can never delay a flood past the client's idle timeout.
+MAX_TCP_WORKERS = 32
+MAX_UDP_WORKERS = 32
+
+# Kernel socket buffer size for the UDP payload socket (12 MiB).
+# Non-root processes are capped by net.core.{w,r}mem_max, so raise those first:
+#   sysctl -w net.core.wmem_max=12582912 net.core.rmem_max=12582912
+SOCKET_BUFFER_SIZE = 12_582_912
+
+
+# Linux sendmmsg(2) via ctypes, so a UDP flood costs one syscall per UDP_BATCH_SIZE packets
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """
+    Returns libc's sendmmsg, or None where it doesn't exist (non-Linux).
+    """
+    if not sys.platform.startswith("linux"):
+        # find_library("c") is None on Windows, and CDLL(None) raises TypeError there
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+_sendmmsg = _load_sendmmsg()
 
 
 def get_local_ip():
@@ -44,24 +126,61 @@ def get_local_ip():
     finally:
         s.close()
 
-def handle_tcp_connection(conn_socket, client_address):
+def create_payload_file():
+    """
+    Create the sparse, self-deleting temp file that TCP payloads are sent from.
+    It takes no disk space; the bytes on the wire are zeros.
+    Returns None where os.sendfile() is unavailable.
+    """
+    if not hasattr(os, "sendfile"):
+        return None
+    payload_file = tempfile.TemporaryFile()
+    os.truncate(payload_file.fileno(), TCP_PAYLOAD_FILE_SIZE)
+    return payload_file
+
+
+def sendfile_all(conn_socket, payload_file, file_size):
+    """
+    Send 'file_size' bytes from 'payload_file' with os.sendfile(), wrapping around its end.
+    - Offsets are explicit, so the file object shared by all connections is never seeked.
+    - Honours the socket timeout while waiting for send buffer space.
+    """
+    out_fd = conn_socket.fileno()
+    in_fd = payload_file.fileno()
+    timeout = conn_socket.gettimeout()
+    bytes_sent = 0
+    with selectors.DefaultSelector() as sel:
+        sel.register(conn_socket, selectors.EVENT_WRITE)
+        while bytes_sent < file_size:
+            offset = bytes_sent % TCP_PAYLOAD_FILE_SIZE
+            count = min(file_size - bytes_sent, TCP_PAYLOAD_FILE_SIZE - offset)
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, count)
+            except BlockingIOError:
+                # A socket with a timeout is non-blocking underneath
+                if not sel.select(timeout):
+                    raise TimeoutError("timed out")
+                continue
+            if not sent:
+                raise ConnectionError("sendfile made no progress")
+            bytes_sent += sent
+
+
+def handle_tcp_connection(conn_socket, client_address, payload_file):
     """
     Handle a single TCP connection from the client.
     - Reads the file size from the client (ASCII + newline).
-    - Sends that many bytes in CHUNK_SIZE blocks.
+    - Sends that many bytes with sendfile() from 'payload_file', or with sendall() where it is None.
     """
     try:
-        data = b""
-        while True:
-            chunk = conn_socket.recv(1024)
-            if not chunk:
-                # Client might have closed the connection
-                cprint(f"[TCP] {client_address} disconnected unexpectedly.", COLOR_RED)
-                return
-            data += chunk
-            if b"\n" in data:
-                # We read until newline
-                break
+        conn_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Buffered reader batches the recv calls while we read until newline
+        with conn_socket.makefile("rb", buffering=65536) as rfile:
+            data = rfile.readline()
+        if not data.endswith(b"\n"):
+            # Client might have closed the connection
+            cprint(f"[TCP] {client_address} disconnected unexpectedly.", COLOR_RED)
+            return
 
         line = data.decode().strip()
         try:
@@ -73,13 +192,14 @@ def handle_tcp_connection(conn_socket, client_address):
         cprint(f"[TCP] {client_address} requested {file_size} bytes.", COLOR_CYAN)
 
         # Send data
-        bytes_sent = 0
-        dummy_chunk = b"A" * CHUNK_SIZE
-        while bytes_sent < file_size:
-            remaining = file_size - bytes_sent
-            to_send = min(remaining, CHUNK_SIZE)
-            conn_socket.sendall(dummy_chunk[:to_send])
-            bytes_sent += to_send
+        if payload_file is None:
+            bytes_sent = 0
+            while bytes_sent < file_size:
+                to_send = min(file_size - bytes_sent, len(TCP_FALLBACK_PAYLOAD))
+                conn_socket.sendall(TCP_FALLBACK_PAYLOAD[:to_send])
+                bytes_sent += to_send
+        else:
+            sendfile_all(conn_socket, payload_file, file_size)
 
         cprint(f"[TCP] Done sending {file_size} bytes to {client_address}", COLOR_GREEN)
 
@@ -95,45 +215,127 @@ def handle_udp_request(server_udp_socket, client_address, file_size):
     - Sends 'file_size' bytes in multiple packets.
     - Each packet has a header with magic cookie, msg type, total segments, current segment index.
     """
-    total_segments = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE  # round up
+    total_segments = (file_size + UDP_CHUNK_SIZE - 1) // UDP_CHUNK_SIZE  # round up
     cprint(f"[UDP] {client_address} requested {file_size} bytes => {total_segments} segments.", COLOR_CYAN)
 
-    dummy_data = b"B" * CHUNK_SIZE
-    for seg_idx in range(total_segments):
-        current_offset = seg_idx * CHUNK_SIZE
-        remaining = file_size - current_offset
-        payload_size = min(CHUNK_SIZE, remaining)
-
-        # Build the header
-        header = struct.pack("!IBQQ",
-                             MAGIC_COOKIE,  # 4 bytes
-                             MSG_TYPE_PAYLOAD,  # 1 byte
-                             total_segments,  # 8 bytes
-                             seg_idx)  # 8 bytes
-        packet = header + dummy_data[:payload_size]
-
+    if _sendmmsg is not None:
         try:
-            server_udp_socket.sendto(packet, client_address)
+            send_udp_batched(server_udp_socket, client_address, file_size, total_segments)
         except Exception as e:
-            cprint(f"[UDP] Error sending seg {seg_idx} to {client_address}: {e}", COLOR_RED)
-            break
+            cprint(f"[UDP] Error sending to {client_address}: {e}", COLOR_RED)
+    else:
+        # Build the packet once; only the segment index in the header changes per send
+        packet = bytearray(PAYLOAD_HEADER.size + UDP_CHUNK_SIZE)
+        packet[PAYLOAD_HEADER.size:] = b"B" * UDP_CHUNK_SIZE
+        packet_view = memoryview(packet)
+        for seg_idx in range(total_segments):
+            current_offset = seg_idx * UDP_CHUNK_SIZE
+            remaining = file_size - current_offset
+            payload_size = min(UDP_CHUNK_SIZE, remaining)
+
+            PAYLOAD_HEADER.pack_into(packet, 0, MAGIC_COOKIE, MSG_TYPE_PAYLOAD, total_segments, seg_idx)
+
+            try:
+                server_udp_socket.sendto(packet_view[:PAYLOAD_HEADER.size + payload_size], client_address)
+            except Exception as e:
+                cprint(f"[UDP] Error sending seg {seg_idx} to {client_address}: {e}", COLOR_RED)
+                break
 
     cprint(f"[UDP] Finished sending {file_size} bytes to {client_address}", COLOR_GREEN)
 
 
+def send_udp_batched(server_udp_socket, client_address, file_size, total_segments):
+    """
+    Send all payload segments with sendmmsg(), UDP_BATCH_SIZE datagrams per syscall.
+    - A fixed ring of packets is built once; only the header is rewritten per batch.
+    - Raises OSError if the kernel rejects a batch.
+    """
+    ip, port = client_address
+    addr = ctypes.create_string_buffer(
+        struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + socket.inet_aton(ip), 16)
+
+    packets = [ctypes.create_string_buffer(PAYLOAD_HEADER.size + UDP_CHUNK_SIZE) for _ in range(UDP_BATCH_SIZE)]
+    iovs = (_IoVec * UDP_BATCH_SIZE)()
+    msgs = (_MMsgHdr * UDP_BATCH_SIZE)()
+    for i, packet in enumerate(packets):
+        packet[PAYLOAD_HEADER.size:] = b"B" * UDP_CHUNK_SIZE
+        iovs[i].iov_base = ctypes.addressof(packet)
+        iovs[i].iov_len = len(packet)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(addr)
+        hdr.msg_namelen = len(addr)
+        hdr.msg_iov = ctypes.pointer(iovs[i])
+        hdr.msg_iovlen = 1
+
+    fd = server_udp_socket.fileno()
+    seg_idx = 0
+    while seg_idx < total_segments:
+        count = min(UDP_BATCH_SIZE, total_segments - seg_idx)
+        for i in range(count):
+            PAYLOAD_HEADER.pack_into(packets[i], 0, MAGIC_COOKIE, MSG_TYPE_PAYLOAD, total_segments, seg_idx + i)
+        if seg_idx + count == total_segments:
+            # Last segment may be short
+            iovs[count - 1].iov_len = PAYLOAD_HEADER.size + file_size - (total_segments - 1) * UDP_CHUNK_SIZE
+
+        sent = 0
+        while sent < count:
+            n = _sendmmsg(fd, ctypes.addressof(msgs[sent]), count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, f"sendmmsg failed at seg {seg_idx + sent}: {os.strerror(err)}")
+            sent += n
+        seg_idx += count
+
+
+def handle_udp_ready(udp_sock, pool):
+    """
+    Called by the selector when the UDP socket has a datagram waiting.
+    Validates the request and queues the payload flood on the UDP worker pool.
+    """
+    try:
+        # The socket stays blocking for the flood senders, so don't let a spurious
+        # readiness wakeup park the selector loop in recvfrom
+        data, addr = udp_sock.recvfrom(1024, RECV_DONTWAIT)
+    except BlockingIOError:
+        return
+    if len(data) < REQUEST_PACKET.size:
+        return
+    cookie, msg_type, file_size = REQUEST_PACKET.unpack_from(data, 0)
+    if cookie != MAGIC_COOKIE or msg_type != MSG_TYPE_REQUEST:
+        return
+    cprint(f"[UDP] Request from {addr}, file_size={file_size}", COLOR_YELLOW)
+    pool.submit(handle_udp_request, udp_sock, addr, file_size)
+
+
+def handle_tcp_accept(tcp_sock, pool, payload_file):
+    """
+    Called by the selector when the listening TCP socket has a pending connection.
+    Accepts it and queues the transfer on the TCP worker pool.
+    """
+    try:
+        conn, caddr = tcp_sock.accept()
+    except BlockingIOError:
+        # Another wakeup already took the connection
+        return
+    cprint(f"[TCP] Accepted connection from {caddr}", COLOR_YELLOW)
+    conn.settimeout(5.0)
+    pool.submit(handle_tcp_connection, conn, caddr, payload_file)
+
+
 def broadcast_offers(stop_event, udp_port, tcp_port):
     """
     Constantly broadcast "offer" messages (UDP) to 255.255.255.255:13117
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.settimeout(0.2)
 
+    # Offer packet: magic cookie (4 bytes), msg type (1 byte), serverUDP (2 bytes), serverTCP (2 bytes)
+    offer = OFFER_HEADER.pack(MAGIC_COOKIE, MSG_TYPE_OFFER, udp_port, tcp_port)
     while not stop_event.is_set():
-        # Offer packet: magic cookie (4 bytes), msg type (1 byte), serverUDP (2 bytes), serverTCP (2 bytes)
-        offer = struct.pack("!IBHH", MAGIC_COOKIE, MSG_TYPE_OFFER, udp_port, tcp_port)
         try:
-            sock.sendto(offer, ("255.255.255.255", BROADCAST_LISTEN_PORT))
+            sock.sendto(offer, BROADCAST_ADDRESS)
         except Exception as e:
             cprint(f"[OFFER] Broadcast error: {e}", COLOR_RED)
 
@@ -157,6 +359,7 @@ def main():
     # Setup TCP listening
     tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # disable Nagle
     tcp_sock.bind(("0.0.0.0", tcp_port))
     tcp_sock.listen(5)
 
@@ -164,7 +367,18 @@ def main():
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     udp_sock.bind(("0.0.0.0", udp_port))
-    udp_sock.settimeout(1.0)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+    # Both sockets are multiplexed by one selector; the UDP socket stays blocking
+    # because worker threads also send payload packets on it.
+    tcp_sock.setblocking(False)
+    payload_file = create_payload_file()
+    tcp_pool = ThreadPoolExecutor(max_workers=MAX_TCP_WORKERS)
+    udp_pool = ThreadPoolExecutor(max_workers=MAX_UDP_WORKERS)
+    sel = selectors.DefaultSelector()
+    sel.register(udp_sock, selectors.EVENT_READ, functools.partial(handle_udp_ready, pool=udp_pool))
+    sel.register(tcp_sock, selectors.EVENT_READ, functools.partial(handle_tcp_accept, pool=tcp_pool, payload_file=payload_file))
 
     # Print server info
     local_ip = get_local_ip()
@@ -172,38 +386,20 @@ def main():
 
     try:
         while True:
-            # Handle UDP requests
-            try:
-                data, addr = udp_sock.recvfrom(1024)
-                if len(data) < 13:
-                    continue
-                cookie, msg_type = struct.unpack_from("!IB", data, 0)
-                if cookie != MAGIC_COOKIE or msg_type != MSG_TYPE_REQUEST:
-                    continue
-                # parse file size
-                file_size = struct.unpack_from("!Q", data, 5)[0]
-                cprint(f"[UDP] Request from {addr}, file_size={file_size}", COLOR_YELLOW)
-                t = threading.Thread(target=handle_udp_request, args=(udp_sock, addr, file_size), daemon=True)
-                t.start()
-            except socket.timeout:
-                pass
-
-            # Handle TCP connections
-            tcp_sock.settimeout(0.5)
-            try:
-                conn, caddr = tcp_sock.accept()
-                cprint(f"[TCP] Accepted connection from {caddr}", COLOR_YELLOW)
-                conn.settimeout(5.0)
-                t = threading.Thread(target=handle_tcp_connection, args=(conn, caddr), daemon=True)
-                t.start()
-            except socket.timeout:
-                pass
+            for key, _ in sel.select(timeout=0.2):
+                callback = key.data
+                callback(key.fileobj)
 
     except KeyboardInterrupt:
         cprint("[SERVER] Shutting down via KeyboardInterrupt...", COLOR_RED)
     finally:
         stop_event.set()
         bcast_thread.join(timeout=1.0)
+        tcp_pool.shutdown(wait=False, cancel_futures=True)
+        udp_pool.shutdown(wait=False, cancel_futures=True)
+        if payload_file is not None:
+            payload_file.close()
+        sel.close()
         tcp_sock.close()
         udp_sock.close()
 